@@ -3,6 +3,7 @@ import time
 from pathlib import Path
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
 DATA_ITEMS = ["cvr", "contest", "office", "candidate", "mark"]
@@ -35,6 +36,25 @@ def extract(match, extractor):
     return match.group(extractor) if isinstance(extractor, int) else extractor
 
 
+def set_sorted_index(df, keys):
+    # Same result as df.set_index(keys).sort_index(), but sorting the raw key
+    # columns with np.lexsort is cheaper than sorting the MultiIndex.
+    order = np.lexsort([df[key].to_numpy() for key in reversed(keys)])
+    return df.take(order).set_index(keys)
+
+
+def factorize_rows(df):
+    # Same codes as df.set_index(list(df.columns)).index.factorize()[0], but without
+    # building a MultiIndex: each row's per-column codes are packed into one uint64.
+    assert len(df.columns) <= 4, "too many columns to pack"
+    packed = np.zeros(len(df), dtype=np.uint64)
+    for col in df.columns:
+        codes, uniques = pd.factorize(df[col])
+        assert len(uniques) < 0xFFFF, f"too many values to pack in {col}"
+        packed = (packed << np.uint64(16)) | (codes + 1).astype(np.uint64)
+    return pd.factorize(packed)[0]
+
+
 @timer
 def read_proc_contest(path, title, contest_query=None, mark_query=None):
     data_proc = read_proc(path)
@@ -78,7 +98,7 @@ def write_proc(path, data_proc):
     path_proc = Path("data") / "processed" / path
     path_proc.mkdir(parents=True, exist_ok=True)
     for item in DATA_ITEMS:
-        data_proc[item].to_parquet(path_proc / f"{item}.pq")
+        data_proc[item].to_parquet(path_proc / f"{item}.pq", compression="zstd")
 
 
 @timer
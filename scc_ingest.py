@@ -1,3 +1,4 @@
+import csv
 import gzip
 import io
 import re
@@ -7,10 +8,49 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-
-from common_lib import create_title, timer, transform, write_proc
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+from common_lib import (
+    create_title,
+    factorize_rows,
+    set_sorted_index,
+    timer,
+    transform,
+    write_proc,
+)
 from scc_transformers import TRANSFORMERS
 
+# The first columns hold ids (CvrNumber through BallotType); the rest hold marks.
+NUM_ID_COLUMNS = 8
+
+# Arrow types of the raw id columns, keyed by column position.
+ID_COLUMN_TYPES = {
+    # CvrNumber, TabulatorNum, BatchId and RecordId may be null for a whole block,
+    # or ="..." wrapped only in some rows; read as strings and convert after cleanup.
+    "0": pa.string(),
+    "1": pa.string(),
+    "2": pa.string(),
+    "3": pa.string(),
+    "4": pa.string(),  # ImprintedId is sometimes missing
+    # CountingGroup, PrecinctPortion and BallotType have few distinct values, so
+    # dictionary-encode them while parsing; they arrive in pandas as categoricals.
+    "5": pa.dictionary(pa.int32(), pa.string()),
+    "6": pa.dictionary(pa.int32(), pa.string()),
+    "7": pa.dictionary(pa.int32(), pa.string()),
+}
+
+# Ids are ASCII, e.g. BallotType "12 (12)" and PrecinctPortion "0001234 (1234-1)".
+# These are matched by Arrow (RE2), so they are kept as pattern strings.
+BALLOT_TYPE_REGEX = r"(?P<a>.+) \((?P<b>.+)\)"
+PRECINCT_REGEX = r"0*(?P<a>\d+) \((?P<Precinct1>\d+)-?(?P<Precinct2>\d*)\)"
+
+# Splits e.g. "Sheriff, Short Term (Vote For=1)" into contest, term and vote_for.
+CONTEST_REGEX = re.compile(
+    r"^(?P<contest>.*?)(?:, (?P<term>[^,]*) Term)? \(Vote For=(?P<vote_for>\d+)\)$"
+)
+
 
 def preprocess_path(path, nrows=None):
     df = read_raw(path, nrows=nrows)
@@ -22,37 +62,31 @@ def preprocess_path(path, nrows=None):
 def read_raw(path, nrows=None):
     path = Path("data") / "raw" / path
     path = list(path.glob("*.gz"))[0]
-    with gzip.open(path) as gz_file:
-        if zipfile.is_zipfile(gz_file):
-            df = read_zipfile(gz_file, nrows)
-        else:
-            gz_file.seek(0)  # is_zipfile modifies buffer pointer, so we need to reset.
-            df = pd.read_csv(gz_file, header=[1, 2, 3], na_values=[0], nrows=nrows)
+    # gzip streams are not seekable, and zipfile seeks constantly; decompress once.
+    raw_file = io.BytesIO(gzip.decompress(path.read_bytes()))
+    if zipfile.is_zipfile(raw_file):
+        df = read_zipfile(raw_file, nrows)
+    else:
+        raw_file.seek(0)  # is_zipfile modifies buffer pointer, so we need to reset.
+        df = read_csv(raw_file, nrows)
     print(f"Raw data total rows: {df.shape[0]}")
     return df
 
 
-def read_zipfile(gz_file, nrows):
-    with zipfile.ZipFile(gz_file, "r") as zip_file:
+def read_zipfile(raw_file, nrows):
+    with zipfile.ZipFile(raw_file, "r") as zip_file:
         total_files = len(zip_file.filelist)
         df_list = []
         for idx, zip_info in enumerate(zip_file.filelist):
             print(idx, "of", total_files, ":", zip_info.filename)
             with zip_file.open(zip_info) as csv_export:
-                csv = [
-                    str(line.decode("utf-8").rstrip())
+                lines = [
+                    line.rstrip() + b"\n"
                     for line in csv_export
                     if not line.startswith(b"1,2,3,4,5,6,7,8,9,10,11,12,13,14,15")
                     and b"redacted" not in line
                 ]
-                csv = io.StringIO("\n".join(csv))
-                df = pd.read_csv(
-                    csv,
-                    header=[1, 2, 3],
-                    na_values=[0],
-                    nrows=nrows,
-                    dtype={4: str},  # ImprintedId is sometimes missing
-                )
+                df = read_csv(io.BytesIO(b"".join(lines)), nrows)
                 df_list.append(df)
                 print(f"Single-file data rows read: {df.shape[0]}")
                 if nrows is not None:
@@ -63,6 +97,51 @@ def read_zipfile(gz_file, nrows):
     return df
 
 
+def read_csv(csv_file, nrows=None):
+    # Equivalent to pd.read_csv(csv_file, header=[1, 2, 3], na_values=[0]), but
+    # using Arrow's multi-threaded parser.  Arrow only handles a single header
+    # row, so the 3-level column index is built here, named the way pandas does.
+    lines = [csv_file.readline().decode("utf-8") for _ in range(4)]
+    header = list(csv.reader(lines))[1:]
+    columns = [
+        tuple(name or f"Unnamed: {idx}_level_{lvl}" for lvl, name in enumerate(names))
+        for idx, names in enumerate(zip(*header))
+    ]
+    names = [str(idx) for idx in range(len(columns))]
+
+    # Mark columns are typed up front, so every streamed batch agrees on them.
+    column_types = {name: pa.float64() for name in names[NUM_ID_COLUMNS:]}
+    column_types.update(ID_COLUMN_TYPES)
+    read_options = pacsv.ReadOptions(skip_rows=4, column_names=names)
+    convert_options = pacsv.ConvertOptions(
+        column_types=column_types,
+        null_values=["", "0"],
+        strings_can_be_null=True,
+    )
+
+    csv_file.seek(0)
+    if nrows is None:
+        table = pacsv.read_csv(
+            csv_file, read_options=read_options, convert_options=convert_options
+        )
+    else:
+        # Stop parsing once enough rows are read, like pd.read_csv(nrows=...).
+        reader = pacsv.open_csv(
+            csv_file, read_options=read_options, convert_options=convert_options
+        )
+        batches = []
+        nrows_read = 0
+        for batch in reader:
+            batches.append(batch)
+            nrows_read += batch.num_rows
+            if nrows_read >= nrows:
+                break
+        table = pa.Table.from_batches(batches, schema=reader.schema).slice(0, nrows)
+    df = table.to_pandas()
+    df.columns = pd.MultiIndex.from_tuples(columns)
+    return df
+
+
 @timer
 def preprocess(df):
     reformat_strings(df)
@@ -78,7 +157,7 @@ def preprocess(df):
     df_candidate = split_candidate(df)
 
     indices = ["contest_id", "cvr_id", "rank", "candidate_id"]
-    df = df.reset_index().set_index(indices).sort_index()
+    df = set_sorted_index(df.reset_index(), indices)
 
     return {
         "cvr": df_cvr,
@@ -90,7 +169,16 @@ def preprocess(df):
 
 
 def reformat_strings(df):
-    df.iloc[:, :5] = df.iloc[:, :5].replace('="(.*)"', r"\1", regex=True)
+    # Strip the ="..." wrapper from id columns; other values are left as is.
+    for col in df.columns[:5]:
+        if df[col].dtype == object:
+            values = df[col]
+            wrapped = (
+                values.str.startswith('="', na=False)
+                & values.str.endswith('"', na=False)
+                & (values.str.len() >= 3)
+            )
+            df[col] = values.where(~wrapped, values.str[2:-1])
 
 
 def set_index(df):
@@ -113,24 +201,53 @@ def check_and_clean_id_invariants(df_id):
     cols = ["TabulatorNum", "BatchId"]
     df_id[cols] = df_id[cols].fillna("0").astype(np.int16)
 
-    df_check = df_id["BallotType"].str.extract(r"(?P<a>.+) \((?P<b>.+)\)")
-    ballot_type_ok = df_check["a"] == df_check["b"]
-    assert ballot_type_ok.all(), "BallotType mismatch"
+    # These columns have few distinct values, so the checks run per category.  The
+    # parser's categories may include values from rows cut by nrows; drop those.
+    ballot_type = df_id["BallotType"].astype("category")
+    ballot_type = ballot_type.cat.remove_unused_categories()
+    ballot_types = pd.Series(ballot_type.cat.categories)
+    df_check = extract_regex(ballot_types, BALLOT_TYPE_REGEX)
+    ballot_type_ok = (df_check["a"] == df_check["b"]).all()
+    assert ballot_type_ok and ballot_type.notna().all(), "BallotType mismatch"
 
-    df_id["BallotType"] = df_check["a"].astype("category")
+    df_id["BallotType"] = map_categories(ballot_type, df_check["a"])
 
-    precinct_regex = r"0*(?P<a>\d+) \((?P<Precinct1>\d+)-?(?P<Precinct2>\d*)\)"
-    df_check = df_id["PrecinctPortion"].str.extract(precinct_regex)
+    precinct_portion = df_id["PrecinctPortion"].astype("category")
+    precinct_portion = precinct_portion.cat.remove_unused_categories()
+    precinct_portions = pd.Series(precinct_portion.cat.categories)
+    df_check = extract_regex(precinct_portions, PRECINCT_REGEX)
 
-    precinct_ok = df_check["a"] == df_check["Precinct1"]
-    assert precinct_ok.all(), "PrecintPortion mismatch"
+    precinct_ok = (df_check["a"] == df_check["Precinct1"]).all()
+    assert precinct_ok and precinct_portion.notna().all(), "PrecintPortion mismatch"
 
     df_id.drop(columns="PrecinctPortion", inplace=True)
-    precints = ["Precinct1", "Precinct2"]
-    df_id[precints] = df_check[precints].astype("category")
+    for precinct in ["Precinct1", "Precinct2"]:
+        df_id[precinct] = map_categories(precinct_portion, df_check[precinct])
 
     df_id["RecordId"] = df_id["RecordId"].astype(np.int32)
-    df_id["CountingGroup"] = df_id["CountingGroup"].astype("category")
+    counting_group = df_id["CountingGroup"].astype("category")
+    counting_group = counting_group.cat.remove_unused_categories()
+    # Sorted categories, like astype("category") on the strings.
+    df_id["CountingGroup"] = counting_group.cat.reorder_categories(
+        sorted(counting_group.cat.categories)
+    )
+
+
+def map_categories(categorical, values):
+    # Replaces each category with the value at the same position.  The result has
+    # sorted categories, like astype("category"), but no row strings are touched.
+    mapped = pd.Categorical(values).take(categorical.cat.codes, allow_fill=True)
+    return mapped.remove_unused_categories()
+
+
+def extract_regex(series, pattern):
+    # Like Series.str.extract with named groups, but using Arrow's RE2 engine.
+    matches = pc.extract_regex(pa.array(series, type=pa.string()), pattern)
+    columns = {
+        field.name: pc.struct_field(matches, field.name).to_pandas()
+        for field in matches.type
+    }
+    return pd.DataFrame(columns).set_index(series.index)
 
 
 def update_column_index(df):
@@ -159,37 +276,37 @@ def update_column_index(df):
 
 
 def tidy(df):
-    df = df.melt(value_name="rank", ignore_index=False).dropna()
-    df["rank"] = df["rank"].astype(np.int8)
-    df.set_index(["contest", "Candidate"], append=True, inplace=True)
-    df.sort_index(inplace=True)
+    # Only pick out the marked cells, rather than melting the mostly-empty matrix.
+    values = df.to_numpy(dtype=np.float32)
+    rows, cols = np.nonzero(~np.isnan(values))
+    index = pd.MultiIndex.from_arrays(
+        [df.index[rows]]
+        + [df.columns.get_level_values(level)[cols] for level in df.columns.names],
+        names=[df.index.name] + df.columns.names,
+    )
+    df = pd.DataFrame({"rank": values[rows, cols].astype(np.int8)}, index=index)
     df.name = "mark"
     return df
 
 
 def split_contest(df):
     contest_level = df.index.names.index("contest")
-    contest_data = [standardize(contest) for contest in df.index.levels[contest_level]]
+    contests = pd.Series(df.index.levels[contest_level].astype(str))
+    df_parts = contests.str.replace("  ", " ").str.extract(CONTEST_REGEX)
+    unmatched = contests[df_parts["contest"].isna()].tolist()
+    assert not unmatched, f"No Vote For found for {unmatched}"
 
-    columns = [
-        "level",
-        "jurisdiction",
-        "office",
-        "district",
-        "term",
-        "vote_for",
-    ]
+    office_levels = ["level", "jurisdiction", "office", "district"]
+    office_data = [transform(contest, TRANSFORMERS) for contest in df_parts["contest"]]
 
-    df_contest = pd.DataFrame(contest_data, columns=columns)
+    df_contest = pd.DataFrame(office_data, columns=office_levels)
     df_contest.index = df_contest.index.astype(np.int16)
     df_contest.index.name = "contest_id"
-    df_contest["term"] = df_contest["term"].astype("category")
-    df_contest["vote_for"] = df_contest["vote_for"].astype(np.int8)
+    df_contest["term"] = df_parts["term"].fillna("Full").astype("category").values
+    df_contest["vote_for"] = df_parts["vote_for"].astype(np.int8).values
     df_contest["ranked"] = False
 
-    office_levels = ["level", "jurisdiction", "office", "district"]
-    oid = df_contest.set_index(office_levels).index.factorize()[0].astype(np.int16)
-    df_contest["office_id"] = oid
+    df_contest["office_id"] = factorize_rows(df_contest[office_levels]).astype(np.int16)
 
     df_office = df_contest[office_levels + ["office_id"]].drop_duplicates()
     office_name = df_office.apply(create_title, axis="columns").astype("category")
@@ -204,27 +321,11 @@ def split_contest(df):
     return df_contest, df_office
 
 
-def standardize(contest):
-    contest = contest.replace("  ", " ")
-
-    match = re.search(r" \(Vote For=(\d+)\)$", contest)
-    vote_for = int(match.group(1))
-    contest = contest[: match.start()]
-
-    match = re.search(r", ([^,]*) Term$", contest)
-    term = match.group(1) if match else "Full"
-    if match:
-        contest = contest[: match.start()]
-
-    return transform(contest, TRANSFORMERS) + (term, vote_for)
-
-
 def split_candidate(df):
     candidate_level = df.index.names.index("Candidate")
-    cand_data = [e.split(";") for e in df.index.levels[candidate_level]]
-    df_candidate = pd.DataFrame(cand_data, columns=["Candidate", "Party"]).replace(
-        "", None
-    )
+    candidates = pd.Series(df.index.levels[candidate_level].astype(str))
+    df_candidate = candidates.str.rsplit(";", n=1, expand=True).replace("", None)
+    df_candidate.columns = ["Candidate", "Party"]
     df_candidate["Party"] = df_candidate["Party"].astype("category")
     df_candidate.index.name = "candidate_id"
     df_candidate.index = df_candidate.index.astype(np.int16)
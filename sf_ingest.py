@@ -1,4 +1,7 @@
+import codecs
+import functools
 import gzip
+import io
 import json
 import zipfile
 from argparse import ArgumentParser
@@ -6,10 +9,46 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-
-from common_lib import create_title, timer, transform, write_proc
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pajson
+
+from common_lib import (
+    create_title,
+    factorize_rows,
+    set_sorted_index,
+    timer,
+    transform,
+    write_proc,
+)
 from sf_transformers import TRANSFORMERS
 
+MARK_DTYPES = {
+    "cvr_id": np.int32,
+    "contest_id": np.int16,
+    "candidate_id": np.int16,
+    "rank": np.int8,
+    "is_vote": np.bool_,
+    "is_ambiguous": np.bool_,
+}
+
+# Only the fields needed for the mark data; everything else is ignored when parsing.
+MARK_TYPE = pa.struct(
+    [
+        ("CandidateId", pa.int16()),
+        ("Rank", pa.int8()),
+        ("IsVote", pa.bool_()),
+        ("IsAmbiguous", pa.bool_()),
+    ]
+)
+CONTEST_TYPE = pa.struct([("Id", pa.int16()), ("Marks", pa.list_(MARK_TYPE))])
+CARD_TYPE = pa.struct([("Contests", pa.list_(CONTEST_TYPE))])
+SESSION_TYPE = pa.struct([("Original", pa.struct([("Cards", pa.list_(CARD_TYPE))]))])
+CVR_EXPORT_SCHEMA = pa.schema([("Sessions", pa.list_(SESSION_TYPE))])
+
+# Bytes of raw CvrExport JSON to parse at a time.
+BATCH_SIZE = 1 << 26
+
 
 def preprocess_path(path, nfiles=None):
     data_raw = read_raw(path, nfiles)
@@ -21,48 +60,50 @@ def preprocess_path(path, nfiles=None):
 def read_raw(path, nfiles):
     path = Path("data") / "raw" / path
     path = list(path.glob("*.gz"))[0]
-    with gzip.open(path) as gz_file:
-        with zipfile.ZipFile(gz_file, "r") as zip_file:
-            with zip_file.open("ContestManifest.json") as contest_manifest:
-                contest_data = json.load(contest_manifest)
-
-            with zip_file.open("CandidateManifest.json") as candidate_manifest:
-                candidate_data = json.load(candidate_manifest)
-
-            mark_data = []
-            cvr_id = 0
-            cvr_data = []
-            total = len(zip_file.filelist)
-            for idx, zip_info in enumerate(zip_file.filelist):
-                if idx == nfiles:
-                    break
-
-                if idx % 1000 == 0:
-                    print(idx, "of", total)
-
-                if not zip_info.filename.startswith("CvrExport_"):
-                    continue
-
-                with zip_file.open(zip_info) as cvr_export:
-                    data = json.load(cvr_export)
-
-                for sess in data["Sessions"]:
-                    orig = sess["Original"]
-                    for card in orig["Cards"]:
-                        cvr_data.append([cvr_id, zip_info.filename])
-                        for contest in card["Contests"]:
-                            contest_id = contest["Id"]
-                            for mark in contest["Marks"]:
-                                data = [
-                                    cvr_id,
-                                    contest_id,
-                                    mark["CandidateId"],
-                                    mark["Rank"],
-                                    mark["IsVote"],
-                                    mark["IsAmbiguous"],
-                                ]
-                                mark_data.append(data)
-                        cvr_id += 1
+    # gzip streams are not seekable, and zipfile seeks constantly; decompress once.
+    zip_bytes = io.BytesIO(gzip.decompress(path.read_bytes()))
+    with zipfile.ZipFile(zip_bytes, "r") as zip_file:
+        contest_data = json.loads(zip_file.read("ContestManifest.json"))
+        candidate_data = json.loads(zip_file.read("CandidateManifest.json"))
+
+        # Each CvrExport file is a single JSON object.  Batches of files are joined
+        # into one stream for Arrow, which parses it into one row per file, so only
+        # one batch of raw JSON is held in memory beyond the archive.
+        cvr_infos = [
+            zip_info
+            for zip_info in zip_file.filelist
+            if zip_info.filename.startswith("CvrExport_")
+        ][:nfiles]
+        filenames = []
+        tables = []
+        batch = io.BytesIO()
+        block_size = 1 << 20
+        total = len(cvr_infos)
+        for idx, zip_info in enumerate(cvr_infos):
+            if idx % 1000 == 0:
+                print(idx, "of", total)
+
+            filenames.append(zip_info.filename)
+            cvr_export = zip_file.read(zip_info).removeprefix(codecs.BOM_UTF8)
+            batch.write(cvr_export)
+            batch.write(b"\n")
+            block_size = max(block_size, len(cvr_export) + 1)
+            if batch.tell() >= BATCH_SIZE or idx == total - 1:
+                batch.seek(0)
+                tables.append(read_cvr_exports(batch, block_size))
+                batch = io.BytesIO()
+
+    if tables:
+        table = pa.concat_tables(tables)
+    else:
+        table = CVR_EXPORT_SCHEMA.empty_table()
+    mark_data, card_file = parse_cvr_exports(table)
+    # Each card refers to its file by index, so the filenames are never repeated.
+    filename = pd.Categorical(filenames).take(card_file).remove_unused_categories()
+    cvr_data = {
+        "cvr_id": np.arange(len(card_file), dtype=np.int32),
+        "filename": filename,
+    }
     return {
         "cvr": cvr_data,
         "contest": contest_data,
@@ -71,12 +112,58 @@ def read_raw(path, nfiles):
     }
 
 
+def read_cvr_exports(cvr_exports, block_size):
+    # Arrow needs each JSON object to fit in a single block.
+    return pajson.read_json(
+        cvr_exports,
+        read_options=pajson.ReadOptions(block_size=block_size),
+        parse_options=pajson.ParseOptions(
+            explicit_schema=CVR_EXPORT_SCHEMA,
+            newlines_in_values=True,
+            unexpected_field_behavior="ignore",
+        ),
+    )
+
+
+def parse_cvr_exports(table):
+    # Returns the typed mark columns, and the file index of each card (cvr).
+    sessions, session_file = flatten(table.column("Sessions").combine_chunks())
+    cards, card_session = flatten(
+        pc.struct_field(pc.struct_field(sessions, "Original"), "Cards")
+    )
+    contests, contest_card = flatten(pc.struct_field(cards, "Contests"))
+    marks, mark_contest = flatten(pc.struct_field(contests, "Marks"))
+
+    # Cards are numbered in file order, so the card index is the cvr_id.
+    mark_data = {
+        "cvr_id": contest_card[mark_contest],
+        "contest_id": to_numpy(pc.struct_field(contests, "Id"))[mark_contest],
+        "candidate_id": to_numpy(pc.struct_field(marks, "CandidateId")),
+        "rank": to_numpy(pc.struct_field(marks, "Rank")),
+        "is_vote": to_numpy(pc.struct_field(marks, "IsVote")),
+        "is_ambiguous": to_numpy(pc.struct_field(marks, "IsAmbiguous")),
+    }
+    mark_data = {
+        col: values.astype(MARK_DTYPES[col], copy=False)
+        for col, values in mark_data.items()
+    }
+    return mark_data, session_file[card_session]
+
+
+def flatten(list_array):
+    # Returns the list elements, and the index of the list each one came from.
+    values = pc.list_flatten(list_array)
+    parents = to_numpy(pc.list_parent_indices(list_array))
+    return values, parents
+
+
+def to_numpy(array):
+    return array.to_numpy(zero_copy_only=False)
+
+
 @timer
 def preprocess(data_raw):
-    df_cvr = pd.DataFrame(data_raw["cvr"], columns=["cvr_id", "filename"])
-    df_cvr = df_cvr.set_index("cvr_id")
-    df_cvr.index = df_cvr.index.astype(np.int32)
-    df_cvr = df_cvr.astype("category")
+    df_cvr = pd.DataFrame(data_raw["cvr"]).set_index("cvr_id")
 
     df_contest = pd.json_normalize(data_raw["contest"], record_path=["List"])
     contest_dtypes = {
@@ -95,14 +182,14 @@ def preprocess(data_raw):
     df_contest.loc[is_ranked, "vote_for"] = df_contest.loc[is_ranked, "NumOfRanks"]
     df_contest = df_contest.set_index("contest_id").sort_index()
 
+    office_levels = ["level", "jurisdiction", "office", "district"]
+    contest_data = [standardize(contest) for contest in df_contest["Description"]]
     df_contest = (
-        df_contest.apply(standardize, axis="columns")
+        pd.DataFrame(contest_data, columns=office_levels, index=df_contest.index)
         .join(df_contest)
         .drop(columns="Description")
     )
-    office_levels = ["level", "jurisdiction", "office", "district"]
-    oid = df_contest.set_index(office_levels).index.factorize()[0].astype(np.int16)
-    df_contest["office_id"] = oid
+    df_contest["office_id"] = factorize_rows(df_contest[office_levels]).astype(np.int16)
 
     df_office = df_contest[office_levels + ["office_id"]].drop_duplicates()
     office_name = df_office.apply(create_title, axis="columns").astype("category")
@@ -132,18 +219,9 @@ def preprocess(data_raw):
     )
     df_candidate = df_candidate.set_index("candidate_id").sort_index()
 
-    mark_dtypes = {
-        "cvr_id": np.int32,
-        "contest_id": np.int16,
-        "candidate_id": np.int16,
-        "rank": np.int8,
-        "is_vote": np.bool_,
-        "is_ambiguous": np.bool_,
-    }
-    df_mark = pd.DataFrame(data_raw["mark"], columns=mark_dtypes.keys())
-    df_mark = df_mark.astype(mark_dtypes)
+    df_mark = pd.DataFrame(data_raw["mark"])
     indices = ["contest_id", "cvr_id", "rank", "candidate_id"]
-    df_mark = df_mark.set_index(indices).sort_index()
+    df_mark = set_sorted_index(df_mark, indices)
 
     return {
         "cvr": df_cvr,
@@ -154,9 +232,9 @@ def preprocess(data_raw):
     }
 
 
-def standardize(row):
-    values = transform(row["Description"], TRANSFORMERS)
-    return pd.Series(values, index=["level", "jurisdiction", "office", "district"])
+@functools.lru_cache(maxsize=None)
+def standardize(contest):
+    return transform(contest, TRANSFORMERS)
 
 
 if __name__ == "__main__":
@@ -164,6 +242,6 @@ if __name__ == "__main__":
     parser.add_argument(
         "path", type=Path, help="path of data: year/state/level/jurisdiction/election"
     )
-    parser.add_argument("--nfiles", type=int, help="# files to process")
+    parser.add_argument("--nfiles", type=int, help="# CvrExport files to process")
     args = parser.parse_args()
     preprocess_path(args.path, args.nfiles)